@@ -113,7 +113,8 @@ class S2LandcoverDataGenerator(tf.keras.utils.Sequence):
                  batch_size=32, 
                  shuffle=True,
                  cache_size=100,
-                 chips_basedirs=None
+                 chips_basedirs=None,
+                 uint8_images=False
                  ):
         self.basedir = basedir
         if chips_basedirs is None:
@@ -124,6 +125,7 @@ class S2LandcoverDataGenerator(tf.keras.utils.Sequence):
         self.batch_size = batch_size
         self.shuffle = shuffle
         self.partitions_id = partitions_id
+        self.uint8_images = uint8_images
         self.on_epoch_end()
         self.cache = {}
         self.cache_size = cache_size
@@ -142,6 +144,28 @@ class S2LandcoverDataGenerator(tf.keras.utils.Sequence):
         if self.shuffle == True:
             np.random.shuffle(self.indexes)
 
+    def as_dataset(self):
+        """
+        wraps this generator into a tf.data.Dataset yielding the same batches,
+        reshuffling at the start of each pass so that partial reads such as
+        take(1) also get a fresh sample.
+        """
+        def generator():
+            self.on_epoch_end()
+            for i in range(len(self)):
+                yield self[i]
+
+        signature = (tf.TensorSpec((None, 100, 100, 3), tf.uint8 if self.uint8_images else tf.float32),
+                     (tf.TensorSpec((None, 12), tf.float32),
+                      tf.TensorSpec((None, 100, 100), tf.int16)))
+        dataset = tf.data.Dataset.from_generator(generator, output_signature=signature)
+        return dataset.apply(tf.data.experimental.assert_cardinality(len(self)))
+
+    def sample(self, n):
+        'Generate a batch of n random chips, leaving the epoch order untouched'
+        indexes = np.random.permutation(len(self.chips_basedirs))[:n]
+        return self.__data_generation([self.chips_basedirs[k] for k in indexes])
+
     def __getitem__(self, index):
         'Generate one batch of data'
         # Generate indexes of the batch
@@ -172,15 +196,16 @@ class S2LandcoverDataGenerator(tf.keras.utils.Sequence):
         'Generates data containing batch_size samples' 
         # X : (n_samples, *dim, n_channels)
         # Initialization
-        X = np.empty((self.batch_size, 100, 100, 3), dtype=np.float32)
-        labels = np.empty((self.batch_size, 100, 100), dtype=np.int16)
-        partition_proportions = np.empty((self.batch_size, 12), dtype=np.float32)
+        n = len(chips_basedirs_temp)
+        X = np.empty((n, 100, 100, 3), dtype=np.uint8 if self.uint8_images else np.float32)
+        labels = np.empty((n, 100, 100), dtype=np.int16)
+        partition_proportions = np.empty((n, 12), dtype=np.float32)
 
         # Generate data
         for i, chip_id in enumerate(chips_basedirs_temp):
             # Store sample
             chip_mean, label, p = self.load_chip(chip_id)
-            X[i,] = chip_mean/256
+            X[i,] = chip_mean if self.uint8_images else chip_mean/256
             labels[i,] = label
             partition_proportions[i,] = p
 
@@ -1,7 +1,6 @@
-from tensorflow.keras.layers import Conv2D, Dropout, MaxPooling2D, Conv2DTranspose, Input, Flatten, concatenate, Lambda
+from tensorflow.keras.layers import Conv2D, SpatialDropout2D, MaxPooling2D, UpSampling2D, Input, Flatten, concatenate, Rescaling, Reshape
 from tensorflow.keras.models import Model
 import tensorflow as tf
-from progressbar import progressbar as pbar
 from datetime import datetime
 from keras.utils.layer_utils import count_params
 import numpy as np
@@ -23,44 +22,151 @@ def mse_proportions_on_chip(y_true, y_pred):
 def custom_compute_iou(class_number, y_true, y_pred):
     """
     assumes y_true/y_pred contain a batch of size (batch_size, other_dims)
-    returns a list of ious of size batch_size
+    returns an array of ious of size batch_size
     """
-    iou_batch = []
-    cy_pred = (y_pred == class_number).astype(int)
-    cy_true = (y_true == class_number).astype(int)
-    for i in range(len(cy_pred)):
-        union        = ((cy_true[i]+cy_pred[i])>=1).sum()
-        intersection = ((cy_true[i]+cy_pred[i])==2).sum()
-        iou = 1 if union==0 else intersection/union
-        iou_batch.append(iou)
-    return np.r_[iou_batch]
+    cy_pred = y_pred == class_number
+    cy_true = y_true == class_number
+    axes = tuple(range(1, cy_pred.ndim))
+    intersection = np.logical_and(cy_true, cy_pred).sum(axis=axes)
+    union        = np.logical_or(cy_true, cy_pred).sum(axis=axes)
+    return np.where(union==0, 1., intersection/np.maximum(union,1))
 
 
-def compute_iou(y_true, y_pred):
-    y_pred = tf.cast(y_pred>0.5, tf.int32)
+def custom_compute_ious(y_true, y_pred, num_classes=2):
+    """
+    same as custom_compute_iou but for all classes at once, from a per chip
+    confusion matrix built with a single pass over the masks.
+    returns an array of ious of size (num_classes, batch_size)
+    """
+    batch_size = len(y_true)
+    y_true = np.asarray(y_true).astype(int).reshape(batch_size, -1)
+    y_pred = np.asarray(y_pred).astype(int).reshape(batch_size, -1)
+    offsets = np.arange(batch_size)[:, np.newaxis] * num_classes**2
+    cm = np.bincount((offsets + y_true*num_classes + y_pred).ravel(),
+                     minlength=batch_size*num_classes**2)
+    cm = cm.reshape(batch_size, num_classes, num_classes)
+    intersection = np.diagonal(cm, axis1=1, axis2=2)
+    union        = cm.sum(axis=1) + cm.sum(axis=2) - intersection
+    ious = np.where(union==0, 1., intersection/np.maximum(union,1))
+    return ious.T
+
+
+@tf.function
+def tf_custom_compute_iou(class_number, y_true, y_pred):
+    """
+    same as custom_compute_iou but with tf ops, so that it stays on device
+    and can run inside the train and val steps
+    """
+    cy_pred = tf.cast(tf.equal(y_pred, tf.cast(class_number, y_pred.dtype)), tf.int32)
+    cy_true = tf.cast(tf.equal(y_true, tf.cast(class_number, y_true.dtype)), tf.int32)
+    intersection = tf.reduce_sum(cy_pred*cy_true, axis=[1,2])
+    union        = tf.reduce_sum(tf.cast((cy_pred+cy_true)>0, tf.int32), axis=[1,2])
+    return tf.where(union==0, 1., tf.cast(intersection, tf.float32) / tf.cast(tf.maximum(union,1), tf.float32))
 
-    # resize smallest
-    if y_true.shape[-1]<y_pred.shape[-1]:
-        y_true = tf.image.resize(y_true[..., tf.newaxis], y_pred.shape[1:], method='nearest')[:,:,:,0]
 
-    if y_pred.shape[-1]<y_true.shape[-1]:
-        y_pred = tf.image.resize(y_pred[..., tf.newaxis], y_true.shape[1:], method='nearest')[:,:,:,0]
+class LabelProportionsModel(tf.keras.Model):
+    """
+    functional model whose train and test steps take batches of (x, (p, l)),
+    so that the losses on label proportions can be trained with Model.fit.
+    the steps themselves are those of the GenericUnet it is built by.
+    """
+    def __init__(self, unet, **kwargs):
+        super().__init__(**kwargs)
+        self.unet = unet
+        names = ['loss', 'iou', 'mseprops_on_chip'] if unet.measure_iou() else ['loss', 'mseprops_on_chip']
+        self.trackers = {i: tf.keras.metrics.Mean(name=i) for i in names}
+
+    @property
+    def metrics(self):
+        return list(self.trackers.values())
+
+    def update_trackers(self, loss, out, iou, l):
+        values = {'loss': loss, 'iou': iou, 'mseprops_on_chip': mse_proportions_on_chip(l, out)}
+        for name, tracker in self.trackers.items():
+            tracker.update_state(values[name])
+        return {name: tracker.result() for name, tracker in self.trackers.items()}
+
+    def train_step(self, data):
+        x, (p, l) = data
+        loss, out, iou = self.unet.train_step(x, p, l)
+        return self.update_trackers(loss, out, iou, l)
+
+    def test_step(self, data):
+        x, (p, l) = data
+        loss, out, iou = self.unet.val_step(x, p, l)
+        return self.update_trackers(loss, out, iou, l)
+
+
+class WandbWindowedLogger(tf.keras.callbacks.Callback):
+    """
+    logs to wandb the means of the train metrics over each window of log_every
+    steps under train/ keys, and the validation metrics at the end of each epoch
+    under val/ keys, using as wandb step the global train step kept by the
+    GenericUnet, so that successive fit calls in the same run keep logging.
+    keras batch logs are running means over the epoch, so window means are
+    obtained from the running means at the window boundaries, which is the only
+    time metrics are brought to host.
+    """
+    # receive batch logs as tensors instead of converting them to numpy every step
+    _supports_tf_logs = True
+
+    def __init__(self, unet, log_every=50):
+        super().__init__()
+        self.unet = unet
+        self.log_every = log_every
+        self.window_sums = {}
+        self.window_steps = 0
+
+    def on_epoch_begin(self, epoch, logs=None):
+        # steps run in this epoch, and steps and running means already added to a window
+        self.epoch_steps = 0
+        self.added_steps = 0
+        self.added_means = {}
+
+    def add_to_window(self, logs):
+        k, j = self.epoch_steps, self.added_steps
+        means = {name: float(v) for name,v in logs.items()}
+        for name, m in means.items():
+            self.window_sums[name] = self.window_sums.get(name, 0.) + k*m - j*self.added_means.get(name, 0.)
+        self.window_steps += k - j
+        self.added_steps, self.added_means = k, means
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.epoch_steps += 1
+        self.unet.train_steps += 1
+
+        if self.unet.train_steps % self.log_every == 0:
+            self.add_to_window(logs)
+            wandb.log({f"train/{k}": v/self.window_steps for k,v in self.window_sums.items()},
+                      step=self.unet.train_steps)
+            self.window_sums = {}
+            self.window_steps = 0
+
+    def on_epoch_end(self, epoch, logs=None):
+        # close the part of the current window that falls in this epoch,
+        # since keras resets the running means at the start of the next one
+        if self.epoch_steps > self.added_steps:
+            self.add_to_window({k:v for k,v in logs.items() if not k.startswith('val_')})
+        wandb.log({f"val/{k[4:]}": v for k,v in logs.items() if k.startswith('val_')}, step=self.unet.train_steps)
 
-    iou_metric = tf.keras.metrics.MeanIoU(num_classes=2)
-    iou_metric.reset_states()
-    iou = iou_metric(y_true, y_pred)
-    return iou
 
 class GenericUnet:
 
+    # whether get_model outputs logits instead of probabilities
+    from_logits = False
+
+    # whether get_model takes raw uint8 chips instead of float chips scaled by 1/256
+    uint8_input = False
+
     def __init__(self, *args, **kwargs):
       # just to have a constructor accepting parameters
       pass
 
+    @tf.function
     def normitem(self, x,l):
         x = x[:,2:-2,2:-2,:]
         l = l[:,2:-2,2:-2]
-        l = (l==2).astype(np.float32)
+        l = tf.cast(l==2, tf.float32)
         return x,l
 
     def init_run(self, datadir, 
@@ -69,11 +175,13 @@ class GenericUnet:
                  train_size=.7, 
                  val_size=0.2, 
                  test_size=0.1,
-                 loss='mse',
+                 loss='binxe',
                  wandb_project = 'qm4labelproportions',
                  wandb_entity = 'rramosp',
                  partitions_id = 'aschips',
-                 cache_size = 10000):
+                 cache_size = 10000,
+                 precision_policy = 'mixed_bfloat16',
+                 jit_compile = True):
 
         self.learning_rate = learning_rate
         self.loss_name = loss
@@ -81,12 +189,22 @@ class GenericUnet:
         self.partitions_id = partitions_id
         self.wandb_project = wandb_project
         self.wandb_entity = wandb_entity
+        self.precision_policy = precision_policy
+        self.jit_compile = jit_compile
 
         self.run_name = f"{self.get_name()}-{self.partitions_id}-{self.loss_name}-{datetime.now().strftime('%Y%m%d[%H%M]')}"
+
+        # the policy is global, so it is set only while building the model
+        previous_policy = tf.keras.mixed_precision.global_policy()
+        tf.keras.mixed_precision.set_global_policy(self.precision_policy)
         self.model = self.get_model()
+        tf.keras.mixed_precision.set_global_policy(previous_policy)
         self.opt = tf.keras.optimizers.Adam(learning_rate = self.learning_rate)
         self.dice_loss = sm.losses.DiceLoss()
         self.binxe_loss = tf.keras.losses.BinaryCrossentropy()
+        self.model = self.wrap_model(self.model)
+        self.finalized = False
+        self.train_steps = 0
 
         self.train_size = train_size
         self.val_size   = val_size
@@ -102,8 +220,14 @@ class GenericUnet:
                 test_size = self.test_size, 
                 val_size = self.val_size,
                 cache_size = cache_size,
-                shuffle = True                                             
+                shuffle = True,
+                uint8_images = self.uint8_input
             )
+        self.tr_ds  = self.get_dataset(self.tr)
+        self.ts_ds  = self.get_dataset(self.ts, cache=True)
+        self.val_ds = self.get_dataset(self.val, cache=True)
+        if len(tf.config.list_logical_devices('GPU'))>0:
+            self.tr_ds = self.tr_ds.apply(tf.data.experimental.prefetch_to_device('/GPU:0'))
 
         if self.wandb_project is not None:
             wconfig = self.get_wandb_config()
@@ -112,10 +236,30 @@ class GenericUnet:
         print ()
         return self
 
+    def get_dataset(self, sequence, cache=False):
+        """
+        builds a prefetched tf.data pipeline over a data generator, with
+        normitem mapped on it so that it overlaps with training. if cache
+        the normalized batches are kept in memory after the first full pass.
+        """
+        def normitem(x, pl):
+            p,l = pl
+            x,l = self.normitem(x,l)
+            return x,(p,l)
+
+        dataset = sequence.as_dataset()\
+                          .map(normitem, num_parallel_calls=tf.data.AUTOTUNE)
+        if cache:
+            dataset = dataset.cache()
+        return dataset.prefetch(tf.data.AUTOTUNE)
+
     def empty_caches(self):
         self.tr.empty_cache()
         self.val.empty_cache()
         self.ts.empty_cache()
+        # rebuilding the cached pipelines drops their in memory caches
+        self.ts_ds  = self.get_dataset(self.ts, cache=True)
+        self.val_ds = self.get_dataset(self.val, cache=True)
         gc.collect()
 
 
@@ -130,38 +274,32 @@ class GenericUnet:
             "batch_size": self.tr.batch_size,
             'trainable_params': self.trainable_params,
             'non_trainable_params': self.non_trainable_params,
-            'loss': self.loss_name
+            'loss': self.loss_name,
+            'precision_policy': self.precision_policy,
+            'jit_compile': self.jit_compile
         }
         return wconfig
 
     def get_val_sample(self, n=10):
-        batch_size_backup = self.val.batch_size
-        self.val.batch_size = n
-        self.val.on_epoch_end()
-        gen_val = iter(self.val) 
-        val_x, (val_p, val_l) = gen_val.__next__()
-        val_x,val_l = self.normitem(val_x,val_l)
+        # loads only n chips and does not reshuffle the val generator
+        val_x, (val_p, val_l) = self.val.sample(n)
+        val_x, val_l = self.normitem(val_x, val_l)
         val_out = self.predict(val_x).numpy()
-
-        # restore val dataset config
-        self.val.batch_size = batch_size_backup
-        self.val.on_epoch_end()
-        return val_x, val_p, val_l, val_out
+        return val_x.numpy(), val_p, val_l.numpy(), val_out
 
     def plot_val_sample(self, n=10):
-        val_x, val_p, val_l, val_out = self.get_val_sample()
+        val_x, val_p, val_l, val_out = self.get_val_sample(n)
         tval_out = (val_out>0.5).astype(int)
-        chip_props_on_out = [i.mean() for i in val_out>0.5]
-        chip_props_on_label = [i.mean() for i in val_l>0.5]
+        chip_props_on_out = tval_out.mean(axis=(1,2))
+        chip_props_on_label = (val_l>0.5).mean(axis=(1,2))
         y_true = val_l
         y_pred = tval_out
+        if y_pred.shape[1:] != y_true.shape[1:]:
+            # patch models output smaller masks than the labels
+            y_pred = tf.image.resize(y_pred[..., np.newaxis], y_true.shape[1:], method='nearest')[:,:,:,0].numpy()
         if self.measure_iou():
-            ious = []
-            for i in range(len(y_true)):
-                iou = compute_iou(y_true[i:i+1], y_pred[i:i+1]).numpy()
-                ious.append(iou)
+            ious = custom_compute_ious(y_true, y_pred, num_classes=2).mean(axis=0)
 
-        #ious = np.r_[[get_iou(class_number=i, y_true=val_l, y_pred=tval_out) for i in range(2)]].mean(axis=0)
         for ax,i in subplots(len(val_x)):
             plt.imshow(val_x[i])        
             if i==0: 
@@ -193,6 +331,16 @@ class GenericUnet:
         raise NotImplementedError()
 
     def get_loss(self, out, p, l):
+        """
+        out is the raw model output, logits if self.from_logits
+        """
+        out = tf.cast(out, tf.float32)
+        if self.from_logits:
+            if self.loss_name == 'binxe':
+                return tf.reduce_mean(
+                        tf.nn.sigmoid_cross_entropy_with_logits(labels=l, logits=out))
+            out = tf.sigmoid(out)
+
         if self.loss_name == 'mse':
           return tf.reduce_mean( (l-out)**2)
         elif self.loss_name == 'dice':
@@ -213,85 +361,127 @@ class GenericUnet:
 
         raise ValueError(f"unkown loss '{self.loss_name}'")
 
-    def predict(self, x):
-        return self.model(x)[:,:,:,0]
-
-    def fit(self, epochs=10):
-
-        gen_val = iter(self.val) 
-        
-        for epoch in range(epochs):
-            print ("\nepoch", epoch, flush=True)
-            for x,(p,l) in pbar(self.tr):
-                # trim to unet input shape
-                x,l = self.normitem(x,l)
-
-                # compute loss
-                with tf.GradientTape() as t:
-                    out = self.predict(x)
-                    loss = self.get_loss(out,p,l)
+    def get_probabilities(self, out):
+        out = tf.cast(out, tf.float32)
+        return tf.sigmoid(out) if self.from_logits else out
 
-                grads = t.gradient(loss, self.model.trainable_variables)
-                self.opt.apply_gradients(zip(grads, self.model.trainable_variables))
-
-                if self.wandb_project is not None:
-                        wandb.log({"train/loss": loss})
-
-                        if self.measure_iou():
-                            tr_iou = compute_iou(l, out)
-                            wandb.log({"train/iou": tr_iou})
-
-                try:
-                    val_x, (val_p, val_l) = gen_val.__next__()
-                except:
-                    gen_val = iter(self.val) 
-                    val_x, (val_p, val_l) = gen_val.__next__()
-
-                val_x,val_l = self.normitem(val_x,val_l)
-                val_out = self.predict(val_x)
-                val_loss = self.get_loss(val_out,val_p,val_l)
+    def predict(self, x):
+        return self.get_probabilities(self.model(x, training=False))
 
+    def wrap_model(self, model):
+        """
+        wraps a model from get_model into a compiled LabelProportionsModel running
+        the train and val steps below, XLA compiled if jit_compile is set.
+        """
+        model = LabelProportionsModel(self, inputs=model.inputs, outputs=model.outputs)
+        model.compile(optimizer=self.opt, jit_compile=self.jit_compile)
+        return model
 
-                if self.wandb_project is not None:
-                    wandb.log({"val/loss": val_loss})
+    def finalize_for_inference(self):
+        """
+        replaces the model by an equivalent one for inference in which each
+        BatchNormalization right after a Conv2D is folded into the conv kernel
+        and bias. the resulting model should not be trained any further.
+        """
+        # batchnorm layers to fold, indexed by the name of their conv
+        folds = {}
+        for layer in self.model.layers:
+            if not isinstance(layer, tf.keras.layers.BatchNormalization) \
+               or len(layer.inbound_nodes)!=1 \
+               or tf.nest.flatten(layer.axis) not in [[3], [-1]]:
+                continue
+            conv = layer.inbound_nodes[0].inbound_layers
+            # only linear convs, otherwise the batchnorm acts after the nonlinearity
+            if type(conv) is Conv2D and len(conv.outbound_nodes)==1 \
+               and conv.get_config()['activation'] == 'linear':
+                folds[conv.name] = layer
+        if len(folds)==0:
+            print ("no batchnorm layers to fold")
+            return self
+        folded_bns = [bn.name for bn in folds.values()]
+
+        def clone(layer):
+            if layer.name in folded_bns:
+                return tf.keras.layers.Activation('linear', name=layer.name, dtype=layer.get_config()['dtype'])
+            config = layer.get_config()
+            if layer.name in folds:
+                config['use_bias'] = True
+            return layer.__class__.from_config(config)
+
+        functional = tf.keras.models.Model(self.model.inputs, self.model.outputs)
+        model = tf.keras.models.clone_model(functional, clone_function=clone)
+
+        for layer in model.layers:
+            if layer.name in folded_bns:
+                continue
+            source = self.model.get_layer(layer.name)
+            if layer.name in folds:
+                bn = folds[layer.name]
+                kernel, *bias = source.get_weights()
+                bias  = bias[0] if len(bias)>0 else 0.
+                gamma = bn.gamma.numpy() if bn.scale else 1.
+                beta  = bn.beta.numpy() if bn.center else 0.
+                scale = gamma / np.sqrt(bn.moving_variance.numpy() + bn.epsilon)
+                layer.set_weights([kernel*scale, (bias - bn.moving_mean.numpy())*scale + beta])
+            else:
+                layer.set_weights(source.get_weights())
+
+        print (f"folded {len(folds)} batchnorm layers")
+        self.model = self.wrap_model(model)
+        self.finalized = True
+        return self
 
-                    if self.measure_iou():
-                        val_iou = compute_iou(val_l, val_out)
-                        wandb.log({"val/iou": val_iou})
+    def get_iou(self, l, out):
+        """
+        per chip IoU of the thresholded output averaged over both classes and the batch
+        """
+        y_pred = tf.cast(out>0.5, tf.float32)
+        if y_pred.shape[1:] != l.shape[1:]:
+            y_pred = tf.image.resize(y_pred[..., tf.newaxis], l.shape[1:], method='nearest')[:,:,:,0]
+        return tf.reduce_mean([tf_custom_compute_iou(i, l, y_pred) for i in range(2)])
+
+    def train_step(self, x, p, l):
+        with tf.GradientTape() as t:
+            out = self.model(x, training=True)
+            loss = self.get_loss(out,p,l)
+
+        grads = t.gradient(loss, self.model.trainable_variables)
+        self.opt.apply_gradients(zip(grads, self.model.trainable_variables))
+        out = self.get_probabilities(out)
+        return loss, out, self.get_iou(l, out)
+
+    def val_step(self, x, p, l):
+        out = self.model(x, training=False)
+        loss = self.get_loss(out,p,l)
+        out = self.get_probabilities(out)
+        return loss, out, self.get_iou(l, out)
+
+    def fit(self, epochs=10, log_every=50):
+        """
+        trains the model with Model.fit, validating on the whole val dataset at
+        the end of each epoch and sending the means of the train metrics over the
+        last log_every steps to wandb
+        """
+        if self.finalized:
+            raise ValueError("model was finalized for inference and cannot be trained any further")
 
-                    wandb.log({'train/mseprops_on_chip': 
-                                    mse_proportions_on_chip(l, out)})
-                    wandb.log({'val/mseprops_on_chip': 
-                                    mse_proportions_on_chip(val_l, val_out)})
+        callbacks = []
+        if self.wandb_project is not None:
+            callbacks.append(WandbWindowedLogger(self, log_every=log_every))
 
+        self.model.fit(self.tr_ds, validation_data=self.val_ds, epochs=epochs, callbacks=callbacks, verbose=2)
 
     def summary_dataset(self, dataset_name):
         assert dataset_name in ['train', 'val', 'test']
 
         if dataset_name == 'train':
-            dataset = self.tr
+            dataset = self.tr_ds
         elif dataset_name == 'val':
-            dataset = self.val
+            dataset = self.val_ds
         else:
-            dataset = self.ts
-
-        losses, ious, mseps = [], [], []
-        for x, (p,l) in pbar(dataset):
-            x,l = self.normitem(x,l)
-            out = self.predict(x)
-            loss = self.get_loss(out,p,l).numpy()
-            if self.measure_iou():
-                iou = compute_iou(l, out).numpy()
+            dataset = self.ts_ds
 
-            msep =  mse_proportions_on_chip(l, out).numpy()
-            losses.append(loss)
-            if self.measure_iou():
-                ious.append(iou)
-            mseps.append(msep)
-        if self.measure_iou():
-            return {'loss': np.mean(losses), 'iou': np.mean(ious), 'mseprops_on_chip': np.mean(mseps)}
-        else:
-            return {'loss': np.mean(losses), 'mseprops_on_chip': np.mean(mseps)}
+        return self.model.evaluate(dataset, return_dict=True)
             
     def summary_result(self):
         """
@@ -305,65 +495,75 @@ class GenericUnet:
 
 class CustomUnetSegmentation(GenericUnet):
 
+    from_logits = True
+    uint8_input = True
+
     def get_name(self):
         return "custom_unet"
 
     def get_model(self):
         input_shape=(96,96,3)
-        activation='sigmoid'
-        # Build U-Net model
-        inputs = Input(input_shape)
-        s = Lambda(lambda x: x / 255) (inputs)
+        # Build U-Net model. SpatialDropout2D drops whole feature maps, which regularizes
+        # more strongly than pointwise dropout, so its rates are half of the former Dropout ones
+        inputs = Input(input_shape, dtype='uint8')
+        # same scaling as the former x/256 in the data generator followed by x/255,
+        # casting to the compute dtype on device
+        s = Rescaling(1./(256*255)) (inputs)
 
         c1 = Conv2D(16, (3, 3), activation='elu', kernel_initializer='he_normal', padding='same') (s)
-        c1 = Dropout(0.1) (c1)
+        c1 = SpatialDropout2D(0.05) (c1)
         c1 = Conv2D(16, (3, 3), activation='elu', kernel_initializer='he_normal', padding='same') (c1)
         p1 = MaxPooling2D((2, 2)) (c1)
 
         c2 = Conv2D(32, (3, 3), activation='elu', kernel_initializer='he_normal', padding='same') (p1)
-        c2 = Dropout(0.1) (c2)
+        c2 = SpatialDropout2D(0.05) (c2)
         c2 = Conv2D(32, (3, 3), activation='elu', kernel_initializer='he_normal', padding='same') (c2)
         p2 = MaxPooling2D((2, 2)) (c2)
 
         c3 = Conv2D(64, (3, 3), activation='elu', kernel_initializer='he_normal', padding='same') (p2)
-        c3 = Dropout(0.2) (c3)
+        c3 = SpatialDropout2D(0.1) (c3)
         c3 = Conv2D(64, (3, 3), activation='elu', kernel_initializer='he_normal', padding='same') (c3)
         p3 = MaxPooling2D((2, 2)) (c3)
 
         c4 = Conv2D(128, (3, 3), activation='elu', kernel_initializer='he_normal', padding='same') (p3)
-        c4 = Dropout(0.2) (c4)
+        c4 = SpatialDropout2D(0.1) (c4)
         c4 = Conv2D(128, (3, 3), activation='elu', kernel_initializer='he_normal', padding='same') (c4)
         p4 = MaxPooling2D(pool_size=(2, 2)) (c4)
 
         c5 = Conv2D(256, (3, 3), activation='elu', kernel_initializer='he_normal', padding='same') (p4)
-        c5 = Dropout(0.3) (c5)
+        c5 = SpatialDropout2D(0.15) (c5)
         c5 = Conv2D(256, (3, 3), activation='elu', kernel_initializer='he_normal', padding='same') (c5)
 
-        u6 = Conv2DTranspose(128, (2, 2), strides=(2, 2), padding='same') (c5)
+        u6 = UpSampling2D((2, 2), interpolation='bilinear') (c5)
+        u6 = Conv2D(128, (3, 3), padding='same') (u6)
         u6 = concatenate([u6, c4])
         c6 = Conv2D(128, (3, 3), activation='elu', kernel_initializer='he_normal', padding='same') (u6)
-        c6 = Dropout(0.2) (c6)
+        c6 = SpatialDropout2D(0.1) (c6)
         c6 = Conv2D(128, (3, 3), activation='elu', kernel_initializer='he_normal', padding='same') (c6)
 
-        u7 = Conv2DTranspose(64, (2, 2), strides=(2, 2), padding='same') (c6)
+        u7 = UpSampling2D((2, 2), interpolation='bilinear') (c6)
+        u7 = Conv2D(64, (3, 3), padding='same') (u7)
         u7 = concatenate([u7, c3])
         c7 = Conv2D(64, (3, 3), activation='elu', kernel_initializer='he_normal', padding='same') (u7)
-        c7 = Dropout(0.2) (c7)
+        c7 = SpatialDropout2D(0.1) (c7)
         c7 = Conv2D(64, (3, 3), activation='elu', kernel_initializer='he_normal', padding='same') (c7)
 
-        u8 = Conv2DTranspose(32, (2, 2), strides=(2, 2), padding='same') (c7)
+        u8 = UpSampling2D((2, 2), interpolation='bilinear') (c7)
+        u8 = Conv2D(32, (3, 3), padding='same') (u8)
         u8 = concatenate([u8, c2])
         c8 = Conv2D(32, (3, 3), activation='elu', kernel_initializer='he_normal', padding='same') (u8)
-        c8 = Dropout(0.1) (c8)
+        c8 = SpatialDropout2D(0.05) (c8)
         c8 = Conv2D(32, (3, 3), activation='elu', kernel_initializer='he_normal', padding='same') (c8)
 
-        u9 = Conv2DTranspose(16, (2, 2), strides=(2, 2), padding='same') (c8)
+        u9 = UpSampling2D((2, 2), interpolation='bilinear') (c8)
+        u9 = Conv2D(16, (3, 3), padding='same') (u9)
         u9 = concatenate([u9, c1], axis=3)
         c9 = Conv2D(16, (3, 3), activation='elu', kernel_initializer='he_normal', padding='same') (u9)
-        c9 = Dropout(0.1) (c9)
+        c9 = SpatialDropout2D(0.05) (c9)
         c9 = Conv2D(16, (3, 3), activation='elu', kernel_initializer='he_normal', padding='same') (c9)
 
-        outputs = Conv2D(1, (1, 1), activation=activation) (c9)
+        outputs = Conv2D(1, (1, 1), dtype='float32') (c9)
+        outputs = Reshape((96, 96), dtype='float32') (outputs)
 
         model = Model(inputs=[inputs], outputs=[outputs])
         
@@ -372,6 +572,8 @@ class CustomUnetSegmentation(GenericUnet):
 
 class SMUnetSegmentation(GenericUnet):
 
+    from_logits = True
+
     def __init__(self, **sm_keywords):
         self.sm_keywords = sm_keywords
         self.backbone = self.sm_keywords['backbone_name']
@@ -382,13 +584,13 @@ class SMUnetSegmentation(GenericUnet):
       return w
 
     def get_model(self):
-        unet = model = sm.Unet(input_shape=(None,None,3), 
-                               **self.sm_keywords)
+        # fixed input shape so that cudnn picks a single conv algorithm, and
+        # built on the unet layers directly so that finalize_for_inference sees them
+        unet = sm.Unet(input_shape=(96,96,3), **self.sm_keywords)
 
-        inp = tf.keras.layers.Input(shape=(None, None, 3))
-        out = unet(inp)
-        out = tf.keras.layers.Conv2D(1, (1,1), padding='same', activation='sigmoid')(out)
-        m = tf.keras.models.Model([inp], [out])
+        out = tf.keras.layers.Conv2D(1, (1,1), padding='same', dtype='float32')(unet.output)
+        out = tf.keras.layers.Reshape((96,96), dtype='float32')(out)
+        m = tf.keras.models.Model([unet.input], [out])
         return m
 
     def get_name(self):
@@ -398,12 +600,20 @@ class SMUnetSegmentation(GenericUnet):
 # Patch extraction as a layer 
 # from https://keras.io/examples/vision/mlp_image_classification/
 class Patches(tf.keras.layers.Layer):
-    def __init__(self, patch_size, image_size, strides):
-        super(Patches, self).__init__()
+    def __init__(self, patch_size, image_size, strides, **kwargs):
+        super(Patches, self).__init__(**kwargs)
         self.patch_size = patch_size
+        self.image_size = image_size
         self.strides = strides
         self.num_patches = (image_size - patch_size) // strides + 1 
 
+    def get_config(self):
+        config = super(Patches, self).get_config()
+        config.update({'patch_size': self.patch_size,
+                       'image_size': self.image_size,
+                       'strides': self.strides})
+        return config
+
     def call(self, images):
         batch_size = tf.shape(images)[0]
         patches = tf.image.extract_patches(
@@ -447,17 +657,18 @@ class PatchProportionsRegression(GenericUnet):
         x = tf.keras.layers.Dense(self.num_units, activation="gelu")(patches)
         # Apply dropout.
         x = tf.keras.layers.Dropout(rate=self.dropout_rate)(x)
-        # Label proportions prediction layer
-        probs = tf.keras.layers.Dense(1, activation="sigmoid")(x)
+        # Label proportions prediction layer, in float32 under mixed precision
+        probs = tf.keras.layers.Dense(1, activation="sigmoid", dtype='float32')(x)
         # Construct image from label proportions
         conv2dt = tf.keras.layers.Conv2DTranspose(filters=1,
                         kernel_size=self.patch_size,
                         strides=self.pred_strides,
                         kernel_initializer=tf.keras.initializers.Ones(),
                         bias_initializer=tf.keras.initializers.Zeros(),
-                        trainable=False)
+                        trainable=False,
+                        dtype='float32')
         probs = tf.reshape(probs, [-1, patch_extr.num_patches, patch_extr.num_patches, 1])
-        out = probs
+        out = tf.keras.layers.Reshape(probs.shape[1:3], dtype='float32')(probs)
         #out = tf.keras.layers.UpSampling2D(size=(2, 2))(probs)
 
         #ones = tf.ones_like(probs)
@@ -497,20 +708,22 @@ class PatchClassifierSegmentation(GenericUnet):
         x = tf.keras.layers.Dense(self.num_units, activation="gelu")(patches)
         # Apply dropout.
         x = tf.keras.layers.Dropout(rate=self.dropout_rate)(x)
-        # Label proportions prediction layer
-        probs = tf.keras.layers.Dense(1, activation="sigmoid")(x)
+        # Label proportions prediction layer, in float32 under mixed precision
+        probs = tf.keras.layers.Dense(1, activation="sigmoid", dtype='float32')(x)
         # Construct image from label proportions
         conv2dt = tf.keras.layers.Conv2DTranspose(filters=1,
                         kernel_size=self.patch_size,
                         strides=self.pred_strides,
                         kernel_initializer=tf.keras.initializers.Ones(),
                         bias_initializer=tf.keras.initializers.Zeros(),
-                        trainable=False)
+                        trainable=False,
+                        dtype='float32')
         probs = tf.reshape(probs, [-1, patch_extr.num_patches, patch_extr.num_patches, 1])
         out = tf.keras.layers.UpSampling2D(size=(2, 2))(probs)
 
         ones = tf.ones_like(probs)
         out = conv2dt(probs) / conv2dt(ones)
+        out = tf.keras.layers.Reshape(out.shape[1:3], dtype='float32')(out)
         m = tf.keras.models.Model([inputs], [out])
         return m
 